@@ -10,21 +10,86 @@ import datetime
 import glob
 import logging
 import numpy as np
+import os
+import selectors
 import serial
 import sys
+import threading
 
 logger = logging.getLogger(__name__)
 
-TIMEDELAY = 100  # Milliseconds between getting new data
+TIMEDELAY = 100  # Milliseconds between updating the receive status
+RXCHUNK = 65536  # Most bytes to take from the serial port per read
+RXBUFSIZE = 65536  # Driver receive buffer to ask for where it can be set
+MAXLINE = 4096  # Longest partial line kept while waiting for its newline
+NUMBERCHARS = b" 0123456789+-.eEinfatyINFATY"  # Bytes a payload of floats (nan/inf too) may hold
+
+
+# =============================================================================
+# Single-producer/single-consumer ring used to hand parsed rows from the data
+# source to the plotter without a lock (Lamport's queue). Only the producer
+# writes tail and only the consumer writes head; under the GIL the slot store
+# is visible before the index store that publishes it. The slots are rows of
+# one preallocated array, so a drain comes out as a ready made 2D block.
+class SPSCRing:
+    def __init__(self, capacity: int, width: int):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.buf = np.full((size, width), np.nan)
+        self.mask = size - 1
+        self.head = 0  # Next slot to read, owned by the consumer
+        self.tail = 0  # Next slot to write, owned by the producer
+
+    # =========================================================================
+    # Copies one row of values in, returns False (dropping it) when the ring
+    # is full. Values past the row width are dropped, missing ones become NaN.
+    def push(self, row) -> bool:
+        tail = self.tail
+        if tail - self.head > self.mask:
+            return False
+        slot = self.buf[tail & self.mask]
+        n = min(len(row), len(slot))
+        slot[:n] = row[:n]
+        slot[n:] = np.nan
+        self.tail = tail + 1
+        return True
+
+    # =========================================================================
+    # Removes and returns everything published so far as an (n, width) array,
+    # oldest first. The tail is read once and the rows are copied out in at
+    # most two slices.
+    def drain(self) -> np.ndarray:
+        head = self.head
+        tail = self.tail
+        start = head & self.mask
+        end = tail & self.mask
+        if start < end or head == tail:
+            out = self.buf[start:end].copy()
+        else:
+            out = np.concatenate((self.buf[start:], self.buf[:end]))
+        self.head = tail
+        return out
 
 
 class LiveDataSource:
     def __init__(self, args: Namespace, window):
         self.ser = None
+        self.rxthread = None
+        self.statusafter = None  # Pending Tk after() id of updateSerialStatus
+        self.selector = None  # Waits on the port and the shutdown pipe (POSIX only)
+        self.shutdown_r = self.shutdown_w = None  # The shutdown pipe's fds
+        self.rxbuf = b""  # Bytes received after the last complete line
+        self.packageState = "bad"  # Set by the receive thread, shown by the Tk one
         self.master = window.master
         self.window = window
         self.IS_SERIAL_CONNECTED = False
-        self.printRawData = False
+
+        # Plain copies of the Tk options parseData needs, so it never has to
+        # call into Tk per line. The traces keep them current.
+        self.updateOptions()
+        self.window.printrawdata.trace_add("write", self.updateOptions)
+        self.window.requirebrackets.trace_add("write", self.updateOptions)
 
         self.refreshSerial()
         menu = self.window.baudrateoptionmenu["menu"]
@@ -76,29 +141,66 @@ class LiveDataSource:
     # =========================================================================
     # Connects GUI to a COM port based on the user selected port.
     def connectToSerial(self):
+        self.disconnectFromSerial()
         try:
             port = self.window.portentrystr.get()
             baudrate = int(self.window.baudrateentrystr.get())
             logger.debug("Connecting to %s at %d" % (port, baudrate))
             self.ser = serial.Serial(port, baudrate, timeout=0.1)
+            # pyserial leaves a 4KB driver buffer on Windows, which overflows at
+            # high baud rates while the plot is redrawing. Only Windows has this.
+            if hasattr(self.ser, "set_buffer_size"):
+                self.ser.set_buffer_size(rx_size=RXBUFSIZE)
             self.ser.flushInput()
+            self.rxbuf = b""
+            self.setLowLatency()
+            if hasattr(self.ser, "fd"):
+                # Writing to the pipe wakes the receive thread up to stop
+                self.selector = selectors.DefaultSelector()
+                self.shutdown_r, self.shutdown_w = os.pipe()
+                self.selector.register(self.ser.fd, selectors.EVENT_READ)
+                self.selector.register(self.shutdown_r, selectors.EVENT_READ)
         except:
             logger.warn(f"Could not connect to {port}")
+            self.closePort()  # Don't leak whatever got opened before the error
             self.toggleSerialConnectedLabel(False)
             return -1
 
         self.IS_SERIAL_CONNECTED = True  # Set GUI state
         self.toggleSerialConnectedLabel(True)  # Show the state
-        self.getSerialValue()
+        self.rxthread = threading.Thread(target=self.run, daemon=True)
+        self.rxthread.start()
+        self.updateSerialStatus()
         logger.debug("Connected")
 
     # =========================================================================
     # Disconnects from whatever serial port is currently active.
     def disconnectFromSerial(self):
         if self.IS_SERIAL_CONNECTED:  # Only do this if already connected.
-            self.ser.close()
+            self.IS_SERIAL_CONNECTED = False  # Tells the receive thread to stop
+            if self.statusafter is not None:
+                self.master.after_cancel(self.statusafter)
+                self.statusafter = None
+            if self.selector is not None:
+                os.write(self.shutdown_w, b"x")
+            self.rxthread.join()
+            self.closePort()
             self.toggleSerialConnectedLabel(False)
-            self.IS_SERIAL_CONNECTED = False
+
+    # =========================================================================
+    # Closes the port, the selector and the shutdown pipe, whichever of them
+    # are open. The receive thread must not be using them anymore.
+    def closePort(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        for fd in (self.shutdown_r, self.shutdown_w):
+            if fd is not None:
+                os.close(fd)
+        self.shutdown_r = self.shutdown_w = None
+        if self.ser is not None:
+            self.ser.close()
+            self.ser = None
 
     # =========================================================================
     # Swap out the string label indicating whether serial is connected.
@@ -133,16 +235,8 @@ class LiveDataSource:
         timestamp = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
         outfname = "SessionLogs/SerialSessionLog_%s.csv" % (timestamp)
         try:
-            hit_data_start = False
             f = open(outfname, "w")
-            for sd in self.serial_data:
-                # Check if we have data yet, don't start appending until that point
-                if not hit_data_start:
-                    if not any(sd):
-                        continue  # Skip to the next data point if all values are zeros
-                    else:
-                        hit_data_start = True
-
+            for sd in self.window.recentData(self.window.count).T:
                 wstr = ""
                 for d in sd:
                     wstr += "%f," % (d)
@@ -165,42 +259,116 @@ class LiveDataSource:
             self.window.packageindicatorlabel.config(fg="black", font=("times", 20, "bold"))
 
     # =========================================================================
-    # Gets the most recent serial value from connection. IMPORTANT.
-    def getSerialValue(self):
+    # Shows the receive thread's state on the GUI. Runs on the Tk thread, since
+    # Tk must not be touched from the receive thread.
+    def updateSerialStatus(self):
         if not self.IS_SERIAL_CONNECTED:
-            logger.warning("No serial connection")
+            return
+        if not self.rxthread.is_alive():
+            self.disconnectFromSerial()
             return
 
         # Schedule the next execution of this function
-        self.master.after(TIMEDELAY, self.getSerialValue)
+        self.statusafter = self.master.after(TIMEDELAY, self.updateSerialStatus)
+
+        self.setPackageIndicator(self.packageState)
 
-        rawdata = self.ser.readline().decode("utf8").strip()
+    # =========================================================================
+    # Receive thread. Gets the most recent serial values from the connection
+    # and hands them to the plotter until disconnected. IMPORTANT.
+    def run(self):
+        while self.IS_SERIAL_CONNECTED:
+            try:
+                chunk = self.readAvailable()
+            except OSError as e:  # SerialException is an OSError too
+                logger.warning(f"Serial read failed: {e}")
+                return
+            if len(chunk) == 0:
+                continue
+            # Split out every complete line, holding on to any partial line
+            self.rxbuf += chunk
+            lines = self.rxbuf.split(b"\n")
+            self.rxbuf = lines.pop()
+            if len(self.rxbuf) > MAXLINE:
+                logger.warning("No newline in %d bytes, dropping them" % len(self.rxbuf))
+                self.rxbuf = b""
+            for line in lines:
+                self.parseData(line.strip())
+
+    # =========================================================================
+    # Copies the parsing options from their Tk variables.
+    def updateOptions(self, *args):
+        self.printRawData = bool(self.window.printrawdata.get())
+        self.requireBrackets = bool(self.window.requirebrackets.get())
+
+    # =========================================================================
+    # Waits for data and returns whatever has arrived. On POSIX this sleeps on
+    # the tty until data or a shutdown request arrives, then takes it all in
+    # one read. Elsewhere it waits up to the port timeout.
+    def readAvailable(self):
+        if self.selector is not None:
+            for key, _ in self.selector.select():
+                if key.fd == self.shutdown_r:
+                    return b""
+            chunk = os.read(self.ser.fd, RXCHUNK)
+            if len(chunk) == 0:
+                raise serial.SerialException("Device reports readiness to read but returned no data")
+            return chunk
+        chunk = self.ser.read(1)
+        waiting = self.ser.in_waiting
+        if waiting:
+            chunk += self.ser.read(waiting)
+        return chunk
+
+    # =========================================================================
+    # Asks the Linux tty driver to pass data on as soon as it arrives instead
+    # of batching it, e.g. the 16ms latency timer on FTDI adapters. pyserial
+    # only has this on Linux and raises ValueError when the driver refuses.
+    def setLowLatency(self):
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (ValueError, AttributeError) as e:
+            logger.debug(f"Could not set low latency mode: {e}")
+
+    # =========================================================================
+    # Parses one line of data and hands the values off to the plotter. Works on
+    # the raw bytes, only decoding when the line is printed.
+    def parseData(self, rawdata: bytes):
         if len(rawdata) == 0:
             return
-        if self.window.printrawdata.get():
-            logger.info(rawdata)
-        l = rawdata.rfind(">")
+        if self.printRawData:
+            logger.info(rawdata.decode("utf8", "replace"))
+        l = rawdata.rfind(b">")
         if l == -1:
             logger.warning("No > delimiter")
-            self.setPackageIndicator("bad")
+            self.packageState = "bad"
             return
-        if self.window.requirebrackets.get():
-            r = rawdata.find("<")
-            if r == -1:
+        r = rawdata.find(b"<", l + 1)
+        if r == -1:
+            if self.requireBrackets:
                 logger.warning("No < delimiter")
-                self.setPackageIndicator("bad")
+                self.packageState = "bad"
                 return
-        else:
-            r = len(rawdata[l + 1 :])
-        splits = rawdata[l + 1 : r].split(" ")
-        logger.debug(f"splits:{splits}")
+            r = len(rawdata)  # Brackets are optional, take the rest of the line
+        payload = rawdata[l + 1 : r]
+        # Anything left after deleting the number bytes can't be a float, so
+        # reject it before converting. One pass in C, nothing allocated when good.
+        # Bytes in the wrong order (e.g. "1..2") get through and are caught by
+        # the strict float() conversion below.
+        if payload.translate(None, NUMBERCHARS):
+            logger.warning(f"Failed to convert {payload.split(b' ')}")
+            self.packageState = "bad"
+            return
+        splits = payload.split(b" ")
         try:
-            splits = [float(v) for v in splits]
+            values = [float(v) for v in splits]
         except ValueError:
             logger.warning(f"Failed to convert {splits}")
-            self.setPackageIndicator("bad")
+            self.packageState = "bad"
             return
+        logger.debug("values:%s", values)
 
-        self.setPackageIndicator("good")
+        self.packageState = "good"
 
-        self.window.data.append(splits)
+        if not self.window.rows.push(values):
+            logger.warning("Plotter not keeping up, dropping data")
@@ -22,8 +22,8 @@ logger = logging.getLogger(__name__)
 def main():
     parser = argparse.ArgumentParser(description="loranet bridge")
     parser.add_argument("-v", "--verbose", action="count", default=0, help="Increase verbosity of outut")
-    parser.add_argument("--max-points", default=10000, help="Maximum number of points to store (default: %(default)s)")
-    parser.add_argument("--max-inputs", default=5, help="Maximum number of vars to plot (default: %(default)s)")
+    parser.add_argument("--max-points", type=int, default=10000, help="Maximum number of points to store (default: %(default)s)")
+    parser.add_argument("--max-inputs", type=int, default=5, help="Maximum number of vars to plot (default: %(default)s)")
     args = parser.parse_args()
 
     if args.verbose == 0:
@@ -11,17 +11,68 @@ import matplotlib
 matplotlib.use("TkAgg")
 from matplotlib import pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.lines import Line2D
 import numpy as np
 import sys
+import time
 from tkinter import Tk, Label, StringVar, Button, OptionMenu, IntVar, Checkbutton
 
-from LiveDataSource import LiveDataSource
+from LiveDataSource import SPSCRing
 
 logger = logging.getLogger(__name__)
 
 TIMEDELAY = 100  # Milliseconds between updating plot
 PLOTRATIO = (9, 6)
 PLOTDPI = 100
+YLIMSHRINKDELAY = 5  # Seconds the y limits are left alone before shrinking to the data
+YLIMSLACK = 0.05  # Fraction of the y span the limits may be loose by before shrinking
+
+
+# =============================================================================
+# Redraws only a set of animated artists over a cached copy of the region they
+# live in (bbox, e.g. their axes), after the BlitManager in the matplotlib
+# blitting tutorial. The cache is refreshed on every full draw of the canvas.
+class BlitManager:
+    def __init__(self, canvas, bbox, animated_artists=()):
+        self.canvas = canvas
+        self.bbox = bbox
+        self.background = None
+        self.artists = []
+        for a in animated_artists:
+            self.addArtist(a)
+        self.canvas.mpl_connect("draw_event", self.onDraw)
+
+    # =========================================================================
+    # Takes over drawing an artist. They are drawn in the order added, so the
+    # last one added ends up on top.
+    def addArtist(self, art):
+        art.set_animated(True)  # Left out of full draws, drawn by us instead
+        self.artists.append(art)
+
+    # =========================================================================
+    def removeArtist(self, art):
+        self.artists.remove(art)
+
+    # =========================================================================
+    # Grabs the freshly drawn background, then puts the artists on top of it.
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.bbox)
+        self.drawArtists()
+
+    # =========================================================================
+    def drawArtists(self):
+        for a in self.artists:
+            self.canvas.figure.draw_artist(a)
+
+    # =========================================================================
+    # Repaints just the artists and pushes the result to the screen.
+    def update(self):
+        if self.background is None:
+            self.canvas.draw_idle()  # Nothing cached yet, onDraw will catch up
+            return
+        self.canvas.restore_region(self.background)
+        self.drawArtists()
+        self.canvas.blit(self.bbox)
 
 
 # =============================================================================
@@ -33,8 +84,16 @@ class PlotterWindow:
         self.master.title("Live Serial Plotter")
         self.master.resizable(False, False)  # Prevent resizing
 
-        # The data, kept up-to-date by the LiveDataSource
-        self.data = [[0 for i in range(args.max_inputs)] for i in range(args.max_points)]
+        # The data, kept up-to-date from the rows the LiveDataSource hands over.
+        # A fixed ring of the last max_points samples, oldest overwritten first.
+        # Stored one input per row, so each line is plotted from contiguous memory.
+        # Every sample is written twice, at i and i + max_points, so the newest
+        # max_points can always be read back as a single view.
+        self.rows = SPSCRing(args.max_points, args.max_inputs)
+        self.capacity = args.max_points
+        self.data = np.zeros((args.max_inputs, 2 * args.max_points))
+        self.head = 0  # Next column of data to be written
+        self.count = 0  # Number of columns of data holding samples
 
         # set up a close window handler
         master.protocol("WM_DELETE_WINDOW", self.die)
@@ -44,10 +103,26 @@ class PlotterWindow:
         self.a1 = self.f1.add_subplot(111)
         self.a1.grid()
         self.a1.set_title("Serial Values")
-        self.a1.set_xticklabels([])
+        self.a1.set_ylabel("Serial Value")
         self.canvas1 = FigureCanvasTkAgg(self.f1, master)
         self.canvas1.get_tk_widget().grid(row=0, column=0, columnspan=6, pady=20)
 
+        # One line per possible input, kept for the life of the window and
+        # only given new data by plotline. Built in a single pass straight from
+        # the colour cycle rather than going through Axes.plot for each.
+        colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+        self.lines = [Line2D([], [], color=colors[i % len(colors)], label=str(i)) for i in range(args.max_inputs)]
+        for line in self.lines:
+            self.a1.add_line(line)
+        self.blitter = BlitManager(self.canvas1, self.a1.bbox, self.lines)
+        self.numpoints = None  # x axis layout the axes are currently set up for
+        self.ylimzero = False  # Whether the y limits were last set for "Show y=0"
+        self.ylimtime = 0.0  # When the y limits were last changed
+        self.ylim = self.a1.get_ylim()  # The y limits last set, saves asking the axes
+        self.plotoptions = None  # Plot options the shown lines were drawn with
+        self.xkey = None  # (# points, # samples) the lines' x data was made for
+        self.legend = None  # Blitted after the lines so it stays on top of them
+
         # Labels
         self.npointslabel = Label(master, text="# Points")
         self.npointslabel.grid(row=1, column=0, sticky="W")
@@ -147,37 +222,128 @@ class PlotterWindow:
         logger.debug("Window closed")
         sys.exit()
 
+    # =========================================================================
+    # Copies a block of newly received rows into the ring and its mirror, in at
+    # most three slice assignments.
+    def storeRows(self, rows):
+        if len(rows) == 0:
+            return
+        cap = self.capacity
+        batch = rows[-cap:].T  # Older rows would be overwritten anyway
+        n = batch.shape[1]
+        end = self.head + n
+        low = min(end, cap)
+        self.data[:, self.head : end] = batch
+        self.data[:, self.head + cap : low + cap] = batch[:, : low - self.head]
+        if end > cap:
+            self.data[:, : end - cap] = batch[:, cap - self.head :]
+        self.head = end % cap
+        self.count = min(self.count + n, cap)
+
+    # =========================================================================
+    # Returns up to the n most recent samples of each input, oldest first. This
+    # is always a view, the mirror means it never has to be stitched together.
+    def recentData(self, n):
+        n = min(n, self.count)
+        end = self.head + self.capacity
+        return self.data[:, end - n : end]
+
+    # =========================================================================
+    # Fits the y limits to the shown data, as lazily as possible since every
+    # change has the axis ticks and labels redone. They grow as soon as the data
+    # no longer fits, but only shrink back once they have been left alone for a
+    # while and are noticeably too loose. Returns whether they changed.
+    def updateYLimits(self, y):
+        if y.size == 0:
+            return False
+        # One C reduction each over the shown block, skipping missing (NaN) and
+        # inf samples, which matplotlib can't use as limits
+        y = np.where(np.isfinite(y), y, np.nan)
+        ymin = np.fmin.reduce(y, axis=None)
+        ymax = np.fmax.reduce(y, axis=None)
+        if np.isnan(ymax):
+            return False
+        zero = bool(self.show_x_axis.get())
+        if zero:
+            if ymax <= 0:
+                return False
+            lo, hi = 0, 1.125 * ymax
+        else:
+            margin = 0.05 * (ymax - ymin) or 0.05 * max(abs(ymax), 1.0)
+            lo, hi = ymin - margin, ymax + margin
+        if not (np.isfinite(lo) and np.isfinite(hi)):
+            return False  # The margin overflowed on huge values
+
+        curlo, curhi = self.ylim
+        now = time.monotonic()
+        if zero == self.ylimzero and lo >= curlo and hi <= curhi:
+            slack = YLIMSLACK * (curhi - curlo)
+            if now < self.ylimtime + YLIMSHRINKDELAY or (lo - curlo < slack and curhi - hi < slack):
+                return False
+        self.a1.set_ylim(lo, hi)
+        self.ylim = (lo, hi)
+        self.ylimzero = zero
+        self.ylimtime = now
+        return True
+
     # =========================================================================
     # Plots the data to the GUI's plot window.
     def plotline(self):
+        # Schedule the next execution of plotter
+        self.master.after(TIMEDELAY, self.plotline)
+
         numpoints = int(self.npointsentrystr.get())
         numinputs = int(self.numinputsentrystr.get())
 
         if self.plotmethodentrystr.get() == "Markers only":
-            plotmethod = "."
+            marker, linestyle = ".", "None"
         elif self.plotmethodentrystr.get() == "Line only":
-            plotmethod = "-"
+            marker, linestyle = "None", "-"
         else:
-            plotmethod = ".-"
-        self.a1.clear()
-
-        serial_plotline = self.data[-numpoints:]
-        for i in range(numinputs):  # Plot each line individually
-            plotline = [x[i] for x in serial_plotline]
-            self.a1.plot(plotline, plotmethod, label=str(i))
-
-        self.a1.grid()
-        if self.show_x_axis.get():
-            self.a1.set_ylim(0, 1.125 * np.amax(np.array(serial_data)))
-
-        # Plot formatting parameters
-        ticklabels = np.linspace(numpoints / 10, 0, 5)
-        self.a1.set(xticks=np.linspace(0, numpoints, 5), xticklabels=ticklabels)
-        self.a1.set_xticklabels([])
-        self.a1.set_ylabel("Serial Value")
-        self.a1.legend(loc=3)
-        self.a1.set_title("Serial Values")
-
-        self.canvas1.draw()  # Actually update the GUI's canvas object
-        # Schedule the next execution of plotter
-        self.master.after(TIMEDELAY, self.plotline)
+            marker, linestyle = ".", "-"
+
+        rows = self.rows.drain()
+        options = (numpoints, numinputs, marker, linestyle, self.show_x_axis.get())
+        if len(rows) == 0 and options == self.plotoptions:
+            return  # Nothing new to draw
+        redraw = options != self.plotoptions  # The legend or axes need redoing
+        self.plotoptions = options
+        self.storeRows(rows)
+
+        serial_plotline = self.recentData(numpoints)[:numinputs]
+        xkey = (numpoints, serial_plotline.shape[1])
+        x = np.arange(numpoints - serial_plotline.shape[1], numpoints)  # Newest sample on the right
+        if redraw:
+            for i, line in enumerate(self.lines):
+                line.set_visible(i < numinputs)
+                line.set_marker(marker)
+                line.set_linestyle(linestyle)
+        # Once the window is full the x data stays the same, so only hand the
+        # shown lines new y data. Hidden lines are left alone entirely.
+        samex = xkey == self.xkey and not redraw
+        self.xkey = xkey
+        for line, y in zip(self.lines[:numinputs], serial_plotline):
+            if samex:
+                line.set_ydata(y)
+            else:
+                line.set_data(x, y)
+
+        # Only redo the axis layout and legend when the options change
+        if numpoints != self.numpoints:
+            self.a1.set_xlim(0, numpoints)
+            self.a1.set_xticks(np.linspace(0, numpoints, 5))
+            self.a1.set_xticklabels([])
+            self.numpoints = numpoints
+        if redraw:  # The legend copies the lines' style, so rebuild it with them
+            if self.legend is not None:
+                self.blitter.removeArtist(self.legend)
+            self.legend = self.a1.legend(handles=self.lines[:numinputs], loc=3)
+            self.blitter.addArtist(self.legend)
+
+        if self.updateYLimits(serial_plotline):
+            redraw = True
+
+        if redraw:
+            self.canvas1.draw_idle()  # Redraw everything once Tk is idle
+        else:
+            self.blitter.update()  # Only the lines changed, repaint just them